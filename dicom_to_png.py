@@ -1,200 +1,624 @@
 import pydicom
 import numpy as np
-from PIL import Image
+import cv2
 import os
 import shutil
 import argparse
+import json
 import pandas as pd
+import threading
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-def crop_borders(image_array, threshold=10):
+try:
+    from pydicom.encaps import generate_frames  # pydicom >= 3
+    FRAMES_KWARG = "number_of_frames"
+except ImportError:
+    from pydicom.encaps import generate_pixel_data_frame as generate_frames
+    FRAMES_KWARG = "nr_frames"
+
+# optional fast decoders for compressed pixel data, pixel_array is used without it
+try:
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
+
+# optional JIT compiler for the single-pass min/max
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# only the tags needed to decode the pixels are parsed
+PIXEL_TAGS = ["Rows", "Columns", "SamplesPerPixel", "BitsAllocated", "BitsStored", "HighBit",
+              "PixelRepresentation", "PhotometricInterpretation", "PlanarConfiguration",
+              "NumberOfFrames", "PixelData"]
+
+# transfer syntax UID -> imagecodecs decoder name
+FAST_DECODERS = {
+    "1.2.840.10008.1.2.4.90": "jpeg2k_decode",  # JPEG 2000 lossless
+    "1.2.840.10008.1.2.4.91": "jpeg2k_decode",  # JPEG 2000
+    "1.2.840.10008.1.2.4.80": "jpegls_decode",  # JPEG-LS lossless
+    "1.2.840.10008.1.2.4.81": "jpegls_decode",  # JPEG-LS near-lossless
+}
+
+# per-thread scratch buffers (normalization, padding canvas), so they are
+# safe to reuse with the thread pool as well as in worker processes
+_local = threading.local()
+
+def _thread_cache(name):
+    """
+    Return the calling thread's cache dict called name, creating it on first use.
+    """
+    cache = getattr(_local, name, None)
+    if cache is None:
+        cache = {}
+        setattr(_local, name, cache)
+    return cache
+
+if njit is not None:
+    @njit(cache=True, nogil=True)
+    def _minmax_flat(flat):
+        lo = flat[0]
+        hi = flat[0]
+        # branch-free min/max so LLVM vectorizes the reduction
+        for i in range(1, flat.size):
+            v = flat[i]
+            lo = min(lo, v)
+            hi = max(hi, v)
+        return lo, hi
+
+    @njit(cache=True, nogil=True)
+    def _normalize_and_bounds(a, mn, value_range, threshold, white_threshold, corners,
+                              corner_height, corner_width, out):
+        # normalize into out and track the bounds of the crop mask in the same sweep
+        h, w = a.shape
+        y0, y1, x0, x1 = h, 0, w, 0
+        for y in range(h):
+            corner_row = corners and (y < corner_height or y >= h - corner_height)
+            for x in range(w):
+                v = np.uint8(np.float32(a[y, x] - mn) * np.float32(255) / value_range)
+                out[y, x] = v
+                if v <= threshold or v > white_threshold:
+                    continue
+                if corner_row and (x < corner_width or x >= w - corner_width):
+                    continue
+                y0 = min(y0, y)
+                y1 = max(y1, y + 1)
+                x0 = min(x0, x)
+                x1 = max(x1, x + 1)
+        return y0, y1, x0, x1
+
+def minmax(image_array):
+    """
+    Return the minimum and maximum of an array.
+    
+    With numba installed both are found in a single pass over the pixels,
+    otherwise NumPy's min and max are used.
+    """
+    if njit is not None and image_array.size:
+        return _minmax_flat(image_array.ravel())
+    return np.min(image_array), np.max(image_array)
+
+def _normalize_range(mn, mx):
+    """
+    float32 divisor mapping the range mn..mx to 0..255 after multiplying by 255.
+    
+    (a - mn) * 255 is exact in float32 for ranges below 2^16, so dividing it by the
+    range afterwards keeps the maximum at exactly 255, while a precomputed
+    255 / range factor can round it down to 254. The price is one more in-place
+    pass over the float32 buffer (*= then /=) than a single fused scale.
+    """
+    # constant images are all zero after subtracting mn, avoid dividing by zero
+    return np.float32(float(mx) - float(mn)) if mx > mn else np.float32(1.0)
+
+def normalize_to_uint8(image_array):
+    """
+    Min-max normalize a pixel array to 0-255.
+    
+    Works in float32 with in-place operations on a reused scratch buffer,
+    avoiding the float64 temporaries of the plain arithmetic expression.
+    
+    Parameters:
+    - image_array: The raw DICOM pixel array.
+    
+    Returns:
+    - Normalized uint8 image array.
+    """
+    mn, mx = minmax(image_array)
+
+    # float32 scratch buffer, reused while image shapes repeat
+    buf_cache = _thread_cache("buf")
+    buf = buf_cache.get(image_array.shape)
+    if buf is None:
+        # only keep the most recent shape around
+        buf_cache.clear()
+        buf = buf_cache[image_array.shape] = np.empty(image_array.shape, dtype=np.float32)
+
+    np.subtract(image_array, mn, out=buf, dtype=np.float32)
+    buf *= np.float32(255)
+    buf /= _normalize_range(mn, mx)
+    return buf.astype(np.uint8, copy=False)
+
+def read_pixel_array(dicom_path):
+    """
+    Read the pixel array of a DICOM file, parsing only the pixel-related tags.
+    
+    JPEG 2000 and JPEG-LS encoded images are decoded directly with imagecodecs if
+    it is installed, everything else (and any image the fast path fails on) goes
+    through pydicom's pixel_array.
+    
+    Parameters:
+    - dicom_path: Path to the DICOM file.
+    
+    Returns:
+    - The pixel array, or None if the file has no pixel data.
+    """
+    dicom_image = pydicom.dcmread(dicom_path, specific_tags=PIXEL_TAGS)
+    if "PixelData" not in dicom_image:
+        return None
+
+    decoder = FAST_DECODERS.get(dicom_image.file_meta.TransferSyntaxUID)
+    if imagecodecs is not None and decoder is not None:
+        try:
+            # mammograms are single frame; the frame count lets fragmented data with an
+            # empty offset table be joined into that frame
+            frame = next(generate_frames(dicom_image.PixelData, **{FRAMES_KWARG: 1}))
+            return getattr(imagecodecs, decoder)(frame)
+        except Exception as e:
+            print(f"Fast decoding failed for {dicom_path}, using pixel_array: {e}")
+
+    return dicom_image.pixel_array
+
+# crop modes of dicom_to_png -> crop_borders options
+CROP_OPTIONS = {
+    "corners": {"white_threshold": 150, "corners": True},
+    "borders": {"white_threshold": None, "corners": False},
+}
+CROP_MODES = ("none",) + tuple(CROP_OPTIONS)
+
+# size of the patient info corners ignored by crop_borders (rows, columns)
+CORNER_HEIGHT = 45
+CORNER_WIDTH = 80
+
+def _corner_lines(n, size):
+    """
+    Boolean mask of the first and last size of n lines, i < size or i >= n - size.
+    """
+    lines = np.zeros(n, dtype=bool)
+    lines[:size] = True
+    lines[max(n - size, 0):] = True
+    return lines
+
+def crop_borders(image_array, threshold=10, white_threshold=150, corners=True):
     """
     Crop the image to the smallest rectangle containing all pixels above a threshold,
-    ignoring corners containing patient informartion according to documentation.
+    optionally ignoring corners containing patient informartion according to documentation.
     
     Parameters:
     - image_array: The normalized image array.
     - threshold: Minimum intensity to be considered non-black.
+    - white_threshold: Maximum intensity to be considered tissue (brighter pixels,
+      e.g. labels, are ignored), None to disable.
+    - corners: Whether to ignore the patient info corners.
     
     Returns:
     - Cropped image array.
     """
-    white_threshold = 150
-    
-    # black out info
-    rem_info = image_array.copy()
-    h, w = rem_info.shape
-    rem_info[:45, :80] = 0       # top left
-    rem_info[:45, w-80:w] = 0    # top right
-    rem_info[h-45:h, :80] = 0    # bottom left
-    rem_info[h-45:h, w-80:w] = 0 # bottom right
-    rem_info[rem_info > white_threshold] = 0
+    # binary mask for above threshold and below white threshold, in one pass
+    if white_threshold is None:
+        mask = image_array > threshold
+    else:
+        mask = (image_array > threshold) & (image_array <= white_threshold)
 
-    # binary mask for above and below threshold
-    mask = rem_info > threshold
+    # ignore info in the corners (same geometry as the numba kernel)
+    if corners:
+        h, w = mask.shape
+        mask[np.ix_(_corner_lines(h, CORNER_HEIGHT), _corner_lines(w, CORNER_WIDTH))] = False
     
+    # rows and columns containing any non-black pixel
+    rows = mask.any(axis=1)
+    cols = mask.any(axis=0)
+
     # catch problems with empty mask
-    if not mask.any():
+    if not rows.any():
         return image_array
 
-    # collect coordinates of the non-black pixels
-    coords = np.argwhere(mask)
-    y0, x0 = coords.min(axis=0)
-    y1, x1 = coords.max(axis=0)
+    # first and last (exclusive) non-black row/column
+    y0, y1 = rows.argmax(), len(rows) - rows[::-1].argmax()
+    x0, x1 = cols.argmax(), len(cols) - cols[::-1].argmax()
     
     # crop to these boundaries
-    return image_array[y0:y1+1, x0:x1+1]
+    return image_array[y0:y1, x0:x1]
+
+def normalize_and_crop(image_array, threshold=10, white_threshold=150, corners=True):
+    """
+    Normalize a raw pixel array to 0-255 and crop it like crop_borders.
+    
+    With numba installed, normalization and the crop bounds are computed by one
+    fused kernel, without the intermediate float buffer and boolean mask.
+    Otherwise this is normalize_to_uint8 followed by crop_borders.
+    
+    Parameters:
+    - image_array: The raw DICOM pixel array.
+    - threshold, white_threshold, corners: See crop_borders.
+    
+    Returns:
+    - Cropped, normalized uint8 image array.
+    """
+    if njit is None or image_array.ndim != 2 or not image_array.size:
+        return crop_borders(normalize_to_uint8(image_array), threshold=threshold,
+                            white_threshold=white_threshold, corners=corners)
+
+    mn, mx = minmax(image_array)
+    out = np.empty(image_array.shape, dtype=np.uint8)
+    y0, y1, x0, x1 = _normalize_and_bounds(image_array, mn, _normalize_range(mn, mx), threshold,
+                                           255 if white_threshold is None else white_threshold,
+                                           corners, CORNER_HEIGHT, CORNER_WIDTH, out)
+
+    # catch problems with empty mask
+    if y1 == 0:
+        return out
+
+    return out[y0:y1, x0:x1]
 
-def resize_with_padding(image, target_size=(512, 512)):
+def resize_with_padding(image_array, target_size=(512, 512)):
     """
     Resize image and pad to target_size.
     
+    Downscaling uses OpenCV's INTER_AREA, upscaling INTER_LANCZOS4.
+    
     Parameters:
-    - image: A PIL Image.
+    - image_array: A uint8 image array.
     - target_size: Tuple (width, height) for desired output size.
     
     Returns:
-    - A new padded PIL Image of size target_size.
+    - A padded uint8 array of shape (height, width). It may be a cached canvas,
+      so use (e.g. save) it before the next call.
     """
-    original_size = image.size  # (width, height)
+    original_height, original_width = image_array.shape
     target_width, target_height = target_size
 
     # get scale factor and new size to fit
-    scale = min(target_width / original_size[0], target_height / original_size[1])
-    new_size = (int(original_size[0] * scale), int(original_size[1] * scale))
+    scale = min(target_width / original_width, target_height / original_height)
+    new_size = (max(1, int(original_width * scale)), max(1, int(original_height * scale)))
     
     # resize
-    resized_image = image.resize(new_size, Image.Resampling.LANCZOS)
+    interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LANCZOS4
+    resized_array = cv2.resize(image_array, new_size, interpolation=interpolation)
 
-    # create image with desired size
-    new_image = Image.new("L", target_size, 0)
+    # reuse black canvas with desired size (rows, columns)
+    canvas_cache = _thread_cache("canvas")
+    canvas = canvas_cache.get(target_size)
+    if canvas is None:
+        canvas = canvas_cache[target_size] = np.zeros((target_height, target_width), dtype=np.uint8)
+    else:
+        canvas.fill(0)
     
     # add cropped image to padding "passpartout"
-    paste_position = ((target_width - new_size[0]) // 2, (target_height - new_size[1]) // 2)
-    new_image.paste(resized_image, paste_position)
+    ox = (target_width - new_size[0]) // 2
+    oy = (target_height - new_size[1]) // 2
+    canvas[oy:oy+new_size[1], ox:ox+new_size[0]] = resized_array
     
-    return new_image
+    return canvas
 
-def dicom_to_png(dicom_path, output_path, target_size=(512, 512), apply_resize=True):
+def write_png(output_path, image_array, compress_level=1):
+    """
+    Write a uint8 array as PNG via a temporary file that is renamed into place,
+    so an interrupted run never leaves a truncated PNG at output_path.
+    
+    The temporary name ends in .tmp, not .png, so leftovers of a killed run are
+    never picked up as images (e.g. by train_test_split.py).
+    """
+    ok, encoded = cv2.imencode(".png", image_array, [cv2.IMWRITE_PNG_COMPRESSION, compress_level])
+    if not ok:
+        raise IOError(f"Could not encode {output_path}")
+
+    tmp_path = output_path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(encoded.tobytes())
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def dicom_to_png(dicom_path, output_path, target_size=(512, 512), apply_resize=True, compress_level=1, crop="corners"):
     """
     Convert DICOM image to PNG and crop it to a desired target size.
     
+    crop is one of CROP_MODES: "corners" crops black borders ignoring the patient
+    info corners and bright labels, "borders" crops black borders only, "none"
+    keeps the full image.
     If apply_resize is True, the cropped image is padded to fit the target_size.
     Otherwise, the cropped image is saved as is.
+    compress_level is the zlib level (0-9) of the PNG encoder; low levels are much
+    faster, files can be shrunk offline afterwards (e.g. with oxipng).
     """
     try:
-        dicom_image = pydicom.dcmread(dicom_path)
+        image_array = read_pixel_array(dicom_path)
 
         # handle problematic images
-        if not hasattr(dicom_image, "pixel_array"):
+        if image_array is None:
             print(f"Skipping {dicom_path}: No pixel data found.")
             return
 
-        image_array = dicom_image.pixel_array
-
-        # normalize pixel values to 0-255
-        image_array = (image_array - np.min(image_array)) / (np.max(image_array) - np.min(image_array)) * 255.0
-        image_array = image_array.astype(np.uint8)
-
-        # crop the image 
-        cropped_array = crop_borders(image_array)
-
-        # convert to a PIL
-        image = Image.fromarray(cropped_array)
+        # normalize pixel values to 0-255 and crop the image
+        if crop == "none":
+            image_array = normalize_to_uint8(image_array)
+        else:
+            image_array = normalize_and_crop(image_array, **CROP_OPTIONS[crop])
 
         # if desired, resize with black padding to target size
         if apply_resize:
-            image = resize_with_padding(image, target_size=target_size)
+            image_array = resize_with_padding(image_array, target_size=target_size)
 
-        # save the output PNG
-        image.save(output_path)
+        # save the output PNG (libpng via OpenCV, no PIL image needed)
+        write_png(output_path, image_array, compress_level=compress_level)
         print(f"Processed: {dicom_path} → {output_path}")
 
     # catch exceptions
     except Exception as e:
         print(f"Error processing {dicom_path}: {e}")
 
-def extract_lesions(dicom_path, annotations_df, output_root, target_size=(512, 512), apply_resize=True):
+def extract_lesions(dicom_path, lesion_boxes, output_root, target_size=(512, 512), apply_resize=True, compress_level=1):
     """
-    Extract lesion regions from a DICOM image based on bounding boxes provided in annotations_df.
+    Extract lesion regions from a DICOM image based on bounding boxes provided in lesion_boxes.
     
-    The CSV (finding_annotations.csv) must include at least the following columns:
-      image_id, study_id, xmin, ymin, xmax, ymax
-    Each lesion is saved as a separate PNG in output_root/<study_id>/lesions/.
+    lesion_boxes is the (lesion_ids, boxes) entry of group_lesion_boxes for this image,
+    boxes holding one (xmin, ymin, xmax, ymax) row per lesion.
+    Each lesion is saved as a separate PNG in output_root, encoded with compress_level.
+    Afterwards the image's sentinel file (see lesion_sentinel) is touched.
     """
     try:
-        dicom_image = pydicom.dcmread(dicom_path)
-        if not hasattr(dicom_image, "pixel_array"):
+        image_array = read_pixel_array(dicom_path)
+        if image_array is None:
             print(f"Skipping {dicom_path}: No pixel data found.")
             return
 
         # normalization
-        image_array = dicom_image.pixel_array
-        image_array = (image_array - np.min(image_array)) / (np.ptp(image_array)) * 255.0
-        image_array = image_array.astype(np.uint8)
+        image_array = normalize_to_uint8(image_array)
 
         # get image ID from the filename
         image_id = os.path.splitext(os.path.basename(dicom_path))[0]
-        # get annotations for respective ID
-        lesion_rows = annotations_df[annotations_df['image_id'] == image_id]
 
         # process each single lesion
-        for idx, row in lesion_rows.iterrows():
-            # handle images without lesions
-            if pd.isnull(row[['xmin', 'ymin', 'xmax', 'ymax']]).any():
-                continue 
-        
-            xmin = int(row['xmin'])
-            ymin = int(row['ymin'])
-            xmax = int(row['xmax'])
-            ymax = int(row['ymax'])
+        h, w = image_array.shape
+        lesion_ids, boxes = lesion_boxes
+        for idx, (xmin, ymin, xmax, ymax) in zip(lesion_ids.tolist(), boxes.tolist()):
+            # clamp bounding boxes to the image and skip empty ones
+            xmin, ymin = max(xmin, 0), max(ymin, 0)
+            xmax, ymax = min(xmax, w), min(ymax, h)
+            if xmax <= xmin or ymax <= ymin:
+                print(f"Skipping empty lesion {idx} of {dicom_path}")
+                continue
 
             # extract lesions using annotation bounding boxes
             lesion_region = image_array[ymin:ymax, xmin:xmax]
-            lesion_img = Image.fromarray(lesion_region)
-
             if apply_resize:
-                lesion_img = resize_with_padding(lesion_img, target_size=target_size)
+                lesion_region = resize_with_padding(lesion_region, target_size=target_size)
 
-            # grab study_id from the CSV for output folder
-            #study_id = str(row['study_id'])
-            #lesion_out_dir = os.path.join(output_root, study_id, "lesions")
-            #os.makedirs(lesion_out_dir, exist_ok=True)
             lesion_filename = f"{image_id}_lesion_{idx}.png"
-            #lesion_out_path = os.path.join(lesion_out_dir, lesion_filename)
             lesion_out_path = os.path.join(output_root, lesion_filename)
-            lesion_img.save(lesion_out_path)
+            write_png(lesion_out_path, lesion_region, compress_level=compress_level)
             print(f"Extracted lesion: {lesion_out_path}")
 
+        # mark the image as done, re-runs skip it while the sentinel is up to date
+        sentinel_path = lesion_sentinel(output_root, image_id)
+        with open(sentinel_path, "a"):
+            pass
+        os.utime(sentinel_path)
+
     # catch exceptions
     except Exception as e:
         print(f"Error extracting lesions from {dicom_path}: {e}")
 
-def process_dicom_folder(input_root, output_root, target_size=(512, 512), apply_resize=False, lesions_flag=False, annotations_df=None):
+def lesion_sentinel(output_root, image_id):
+    """
+    Path of the empty file marking that the lesions of image_id were extracted.
+    """
+    return os.path.join(output_root, ".done", image_id)
+
+def list_lesion_crops(output_root):
+    """
+    Map image_id to the paths of the lesion crops already in output_root.
+    """
+    crops = {}
+    with os.scandir(output_root) as entries:
+        for entry in entries:
+            name = entry.name
+            if name.endswith(".png") and "_lesion_" in name and entry.is_file():
+                crops.setdefault(name.split("_lesion_")[0], []).append(entry.path)
+    return crops
+
+def options_path(output_root):
+    """
+    Path of the file recording the options the outputs in output_root were made with.
+    """
+    return os.path.join(output_root, ".done", "options.json")
+
+def options_match(output_root, options):
+    """
+    Check whether the outputs in output_root were completed with the same options.
+    """
+    try:
+        with open(options_path(output_root)) as f:
+            return json.load(f) == options
+    except (FileNotFoundError, ValueError):
+        return False
+
+def is_up_to_date(output_path, source_mtime):
+    """
+    Check whether output_path exists and is not older than source_mtime.
+    """
+    try:
+        return os.stat(output_path).st_mtime >= source_mtime
+    except FileNotFoundError:
+        return False
+
+def group_lesion_boxes(annotations_df):
+    """
+    Group lesion bounding boxes of finding_annotations.csv by image.
+    
+    The CSV must include at least the following columns:
+      image_id, xmin, ymin, xmax, ymax
+    Rows without a bounding box (images without lesions) are dropped.
+    
+    Parameters:
+    - annotations_df: The annotations DataFrame.
+    
+    Returns:
+    - Dict mapping image_id to (lesion_ids, boxes), where lesion_ids are the row labels
+      used in the output filenames and boxes is an int32 array of (xmin, ymin, xmax, ymax).
+    """
+    boxes = annotations_df[['xmin', 'ymin', 'xmax', 'ymax']].to_numpy(dtype=np.float64)
+    valid = ~np.isnan(boxes).any(axis=1)
+    annotations_df = annotations_df[valid]
+    boxes = boxes[valid].astype(np.int32)
+    lesion_ids = annotations_df.index.to_numpy()
+
+    return {image_id: (lesion_ids[pos], boxes[pos])
+            for image_id, pos in annotations_df.groupby('image_id').indices.items()}
+
+def iter_files(root):
+    """
+    Recursively yield (folder, DirEntry) for every file below root.
+    
+    Uses os.scandir, so file types come from the directory listing without an
+    extra stat() per entry. Files of a folder are yielded before its subfolders.
+    Like os.walk, unreadable folders are skipped and symlinked folders are not
+    followed (nor yielded as files).
+    """
+    subdirs = []
+    try:
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif not entry.is_dir():
+                    yield root, entry
+    except OSError as e:
+        print(f"Skipping folder {root}: {e}")
+    for subdir in subdirs:
+        yield from iter_files(subdir)
+
+def _init_worker():
+    """
+    Pool initializer: keep OpenCV single-threaded, the pool already runs one
+    conversion per core and OpenCV's own thread pool would oversubscribe the CPUs.
+    """
+    cv2.setNumThreads(1)
+
+def _convert_one(task, lesions_flag, target_size, apply_resize, compress_level, crop):
+    """
+    Worker for process_dicom_folder: run the matching conversion for one
+    (input_path, lesion_boxes, output_path) task.
+    """
+    input_path, lesion_boxes, output_path = task
+    if lesions_flag:
+        extract_lesions(input_path, lesion_boxes, output_path, target_size=target_size,
+                        apply_resize=apply_resize, compress_level=compress_level)
+    else:
+        dicom_to_png(input_path, output_path, target_size=target_size,
+                     apply_resize=apply_resize, compress_level=compress_level, crop=crop)
+
+def process_dicom_folder(input_root, output_root, target_size=(512, 512), apply_resize=False, lesions_flag=False, annotations_df=None, workers=None, compress_level=1, use_threads=False, overwrite=False, annotations_mtime=0.0, crop="corners"):
     """
     Process all DICOM images in subfolders, converting them to PNG.
     
     If apply_resize is True, each image is resized (with padding) to target_size.
-    If lesions_flag is False, converts full DICOM images to PNG (cropped/resized as specified).
+    If lesions_flag is False, converts full DICOM images to PNG (cropped according to
+    the crop mode and resized as specified).
     If True, extracts lesion regions based on bounding boxes from annotations_df.
 
+    Files are collected first and then converted in parallel by a pool of
+    workers (workers, defaults to the number of CPUs). These are processes, or
+    threads if use_threads is True; threads avoid pickling tasks and results and
+    scale because pydicom's compiled decoders, OpenCV and libpng release the GIL
+    during the heavy work.
+    PNGs are written with the zlib compress_level.
+
+    Unless overwrite is True, DICOMs whose output is at least as new as the DICOM
+    are skipped. For lesions the per-image sentinel is checked instead, and must
+    also be newer than annotations_mtime (the CSV's modification time), so an
+    updated CSV triggers re-extraction. Before an image is re-extracted, its
+    existing crops in output_root are removed, as the lesion numbers in their
+    names are CSV row labels and may have shifted.
+    Skipping only applies if the previous run into output_root finished with the
+    same options (recorded in .done/options.json), otherwise everything is redone.
+
     Also copies index.html files.
     """
-    for subdir, _, files in os.walk(input_root):
-        for file in files:
-            input_file_path = os.path.join(subdir, file)
-            if file.lower().endswith(".dicom"):
-                if lesions_flag:
-                    extract_lesions(input_file_path, annotations_df, output_root, target_size=target_size, apply_resize=apply_resize)
-                else:        
-                    relative_path = os.path.relpath(subdir, input_root)
-                    output_subdir = os.path.join(output_root, relative_path)
+    if workers is None:
+        workers = os.cpu_count()
+
+    # outputs made with other options are stale; the record is removed until this
+    # run has finished, so an interrupted run is never mistaken for a complete one
+    options = {"lesions": lesions_flag, "resize": apply_resize,
+               "target_size": list(target_size), "compress_level": compress_level}
+    if not lesions_flag:
+        # lesion crops come from bounding boxes, the crop mode does not affect them
+        options["crop"] = crop
+    os.makedirs(os.path.join(output_root, ".done"), exist_ok=True)
+    if not options_match(output_root, options):
+        overwrite = True
+        if os.path.exists(options_path(output_root)):
+            os.remove(options_path(output_root))
+
+    # group annotations by image once instead of filtering the whole table per file
+    lesion_groups = {}
+    existing_crops = {}
+    if lesions_flag:
+        lesion_groups = group_lesion_boxes(annotations_df)
+        existing_crops = list_lesion_crops(output_root)
+
+    tasks = []
+    last_subdir = output_subdir = None
+    for subdir, entry in iter_files(input_root):
+        # files of one folder arrive together, so the output folder only changes with it
+        if subdir != last_subdir:
+            last_subdir = subdir
+            output_subdir = os.path.join(output_root, os.path.relpath(subdir, input_root))
+            created = False
+        name = entry.name
+        if name.lower().endswith(".dicom"):
+            if lesions_flag:
+                image_id = os.path.splitext(name)[0]
+                lesion_boxes = lesion_groups.get(image_id)
+                if lesion_boxes is None:
+                    continue
+                if not overwrite and is_up_to_date(lesion_sentinel(output_root, image_id),
+                                                   max(entry.stat().st_mtime, annotations_mtime)):
+                    continue
+                # drop crops of a previous extraction, they would linger as stale duplicates
+                for crop_path in existing_crops.get(image_id, ()):
+                    os.remove(crop_path)
+                tasks.append((entry.path, lesion_boxes, output_root))
+            else:
+                # create output folders up front so workers never race on them
+                if not created:
                     os.makedirs(output_subdir, exist_ok=True)
-                    output_file_path = os.path.join(output_subdir, os.path.splitext(file)[0] + ".png")
-                    dicom_to_png(input_file_path, output_file_path, target_size=target_size, apply_resize=apply_resize)
-            elif file == "index.html" and not lesions_flag:
-                relative_path = os.path.relpath(subdir, input_root)
-                output_subdir = os.path.join(output_root, relative_path)
-                shutil.copy(input_file_path, output_subdir)
+                    created = True
+                output_file_path = os.path.join(output_subdir, os.path.splitext(name)[0] + ".png")
+                if not overwrite and is_up_to_date(output_file_path, entry.stat().st_mtime):
+                    continue
+                tasks.append((entry.path, None, output_file_path))
+        elif name == "index.html" and not lesions_flag:
+            if not created:
+                os.makedirs(output_subdir, exist_ok=True)
+                created = True
+            shutil.copy(entry.path, output_subdir)
+
+    # convert in parallel, every file is independent
+    convert = partial(_convert_one, lesions_flag=lesions_flag, target_size=target_size,
+                      apply_resize=apply_resize, compress_level=compress_level, crop=crop)
+    pool = ThreadPoolExecutor if use_threads else ProcessPoolExecutor
+    with pool(max_workers=workers, initializer=_init_worker) as executor:
+        list(executor.map(convert, tasks, chunksize=16))
+
+    with open(options_path(output_root), "w") as f:
+        json.dump(options, f)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -202,26 +626,49 @@ if __name__ == "__main__":
     )
     parser.add_argument("in_folder", help="Path to the input folder containing DICOM images.")
     parser.add_argument("out_folder", help="Path to the output folder for PNG images.")
+    parser.add_argument("--crop", choices=CROP_MODES, default="corners",
+                        help="Cropping of full images: black borders ignoring the patient info "
+                             "corners (default), black borders only, or none.")
     parser.add_argument("--resize", action="store_true", 
                         help="Apply resizing with padding to a uniform target size.")
+    parser.add_argument("--out-size", type=int, default=512,
+                        help="Side length of the square target size for --resize (default: 512).")
     parser.add_argument("--lesions", action="store_true", 
                         help="Extract lesions based on finding_annotations.csv.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of parallel workers (default: number of CPUs).")
+    parser.add_argument("--threads", action="store_true",
+                        help="Use a thread pool instead of worker processes.")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Reprocess all DICOMs, including those with up-to-date outputs.")
+    parser.add_argument("--compress-level", "--compress_level", type=int, default=1, choices=range(10), metavar="{0-9}",
+                        help="zlib compression level of the PNG encoder (default: 1).")
     
     args = parser.parse_args()
 
     # load annotation CSV for lesion extraction
+    annotations_path = "../shared_data/VinDr_Mammo/finding_annotations.csv" # NEED TO KEEP THIS UP TO DATE
     annotations_df = None
+    annotations_mtime = 0.0
     if args.lesions:
         try:
-            annotations_df = pd.read_csv("../shared_data/VinDr_Mammo/finding_annotations.csv") # NEED TO KEEP THIS UP TO DATE
+            annotations_df = pd.read_csv(annotations_path)
+            annotations_mtime = os.stat(annotations_path).st_mtime
             print("Loaded finding_annotations.csv")
         except Exception as e:
             print(f"Error loading finding_annotations.csv: {e}")
             exit(1)
 
     process_dicom_folder(args.in_folder, args.out_folder,
+                         target_size=(args.out_size, args.out_size),
                          apply_resize=args.resize,
                          lesions_flag=args.lesions,
-                         annotations_df=annotations_df)
+                         annotations_df=annotations_df,
+                         workers=args.workers,
+                         compress_level=args.compress_level,
+                         use_threads=args.threads,
+                         overwrite=args.overwrite,
+                         annotations_mtime=annotations_mtime,
+                         crop=args.crop)
 
     print("Done!")
@@ -1,13 +1,13 @@
 import os
 import pandas as pd
-import shutil
 
 # Paths
 lesion_dir = "../lesions_png"
 csv_path = "../../shared_data/VinDr_Mammo/finding_annotations.csv"
 
-# Load annotations CSV
-df = pd.read_csv(csv_path)
+# Load annotations CSV (only the columns needed for the split)
+df = pd.read_csv(csv_path, usecols=["image_id", "split"],
+                 dtype={"image_id": "string", "split": "category"})
 
 # Create output directories
 train_dir = os.path.join(lesion_dir, "training")
@@ -16,27 +16,31 @@ os.makedirs(train_dir, exist_ok=True)
 os.makedirs(test_dir, exist_ok=True)
 
 # Dictionary mapping image_id to split type
-split_dict = dict(zip(df["image_id"], df["split"]))
+split_dict = df.set_index("image_id", drop=True)["split"].to_dict()
 
-# Process lesion files
-for filename in os.listdir(lesion_dir):
-    if filename.endswith(".png"):
+# Destination directory per split type
+dest_dirs = {"training": train_dir, "test": test_dir}
+
+# Process lesion files (list the directory up front, files are moved while iterating)
+with os.scandir(lesion_dir) as it:
+    entries = list(it)
+
+for entry in entries:
+    filename = entry.name
+    if filename.endswith(".png") and entry.is_file():
         image_id = filename.split("_lesion_")[0]
 
-        if image_id in split_dict:
-            split = split_dict[image_id]
-            if split == "training":
-                dest_dir = train_dir
-            elif split == "test":
-                dest_dir = test_dir
-            else:
+        split = split_dict.get(image_id)
+        if split is not None:
+            dest_dir = dest_dirs.get(split)
+            if dest_dir is None:
                 print(f"Split unknown for {filename}, skipping...")
                 continue
 
-            src_path = os.path.join(lesion_dir, filename)
             dest_path = os.path.join(dest_dir, filename)
-            
-            shutil.move(src_path, dest_path) 
+
+            # Same filesystem, so a plain rename suffices
+            os.replace(entry.path, dest_path)
             print(f"Moved {filename} to {dest_dir}/")
 
 print("Finished moving lesion images.")